@@ -0,0 +1,109 @@
+# !/usr/bin/env python
+
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import match
+import isbnutils
+import match_before
+
+MATCHERS = ('lcc', 'ddc', 'isbn', 'issn')
+SCANNED = ('lcc', 'ddc', 'isbn') # what a file scan looks for by default
+
+def load_corpus() -> list:
+    """ the page texts of match_corpus.txt, one per form feed """
+    with open(os.path.join(BENCH_DIR, 'match_corpus.txt'), encoding='utf-8') as f:
+        return [i.strip('\n') for i in f.read().split('\f')]
+
+def random_isbn(rng, valid=True) -> str:
+    if rng.random() < 0.5:
+        core = rng.choice(['978', '979']) + ''.join(rng.choice('0123456789') for _ in range(9))
+        isbn = core + isbnutils.check_digit13(core)
+    else:
+        core = ''.join(rng.choice('0123456789') for _ in range(9))
+        isbn = core + isbnutils.check_digit10(core)
+    if not valid:
+        isbn = isbn[:-1] + str((int(isbn[-1]) + 1) % 10 if isbn[-1] != 'X' else 0)
+    # written with the hyphens or spaces of a printed isbn
+    sep = rng.choice(['', '-', ' ', '–'])
+    cuts = sorted(rng.sample(range(1, len(isbn) - 1), 3))
+    return sep.join(isbn[a:b] for a, b in zip([0] + cuts, cuts + [len(isbn)]))
+
+def random_text(rng) -> str:
+    """ a mix of isbn, lcc, ddc and issn fragments, labels, filler words and line breaks """
+    parts = []
+    for _ in range(rng.randint(1, 12)):
+        parts.append(rng.choice([
+            lambda: random_isbn(rng, rng.random() < 0.8),
+            lambda: rng.choice(['ISBN', 'isbn', 'ISBN:', 'ISBN-10', 'ISBN-13', 'eISBN']),
+            lambda: f"{rng.choice(['Q', 'QA', 'PR', 'B L', 'KF'])}{rng.randint(1, 9999)}{rng.choice(['', '.7', '.73'])}"
+                    f"{rng.choice([' ', '.', ' .'])}{rng.choice('ABCDLPS')}{rng.randint(1, 999)} {rng.randint(1950, 2025)}",
+            lambda: f"{rng.randint(100, 999)}{rng.choice(['', chr(39), '′'])}.{rng.randint(0, 9999)}"
+                    f"{rng.choice(['-', '--', '—', '–'])}dc{rng.choice(['', ' '])}{rng.choice(['20', '21', '22'])}",
+            lambda: f"{rng.randint(1000, 9999)}-{rng.randint(100, 999)}{rng.choice('0123456789X')}",
+            lambda: rng.choice(['(pbk.)', 'hardback', 'Printed in', 'p. cm.', 'Title', '2009', 'vol. 3']),
+            lambda: '\n',
+        ])())
+    return ' '.join(parts)
+
+def compare(texts) -> list:
+    """ (text index, matcher, before, after) of every result that differs from match_before """
+    diffs = []
+    for n, text in enumerate(texts):
+        for i in MATCHERS:
+            before = getattr(match_before, f'match_{i}')(text)
+            after = getattr(match, f'match_{i}')(text)
+            if before != after:
+                diffs.append((n, i, before, after))
+    return diffs
+
+def timed(module, texts, runs) -> float:
+    """ mean milliseconds to run the SCANNED matchers of module over texts """
+    funcs = [getattr(module, f'match_{i}') for i in SCANNED]
+    total = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        for text in texts:
+            for func in funcs:
+                func(text)
+        total += time.perf_counter() - start
+    return total / runs * 1000
+
+def main(argv):
+    """ checks match.py gives the results of match_before.py on the corpus and random texts, then times both """
+    parser = argparse.ArgumentParser(prog="match_bench")
+    parser.add_argument("--random", type=int, default=3000, help="number of random texts to compare")
+    parser.add_argument("--seed", type=int, default=25, help="seed of the random texts")
+    parser.add_argument("--runs", type=int, default=3, help="timing runs to average")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus()
+    rng = random.Random(args.seed)
+    texts = corpus + [i.replace('\n', ' ') for i in corpus] + [random_text(rng) for _ in range(args.random)]
+    diffs = compare(texts)
+    print(f'compared {len(texts)} texts ({len(corpus)} corpus pages, the same pages on one line, {args.random} random)')
+    for n, i, before, after in diffs[:20]:
+        print(f'  text {n} match_{i}: before {before!r}, after {after!r}')
+    print(f'{len(diffs)} differences')
+
+    benches = {
+        'corpus pages x20': corpus * 20,
+        'random texts': texts[2 * len(corpus):],
+        # a label early in a long line of prose, where the old isbn lookbehind rescanned the line at every digit
+        'one long line': ['ISBN ' + ' '.join(f'page {i} of the text, 12 lines' for i in range(800)) + ' 0-306-40615-2'],
+    }
+    for name, bench in benches.items():
+        chars = sum(len(i) for i in bench)
+        before, after = timed(match_before, bench, args.runs), timed(match, bench, args.runs)
+        print(f'{name} ({chars} characters): {before:.1f} ms before, {after:.1f} ms after, {before / after:.1f}x')
+
+    return 1 if diffs else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+# !/usr/bin/env python
+
+import logging
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+def normalize_url(url):
+    """ cache key for a request url: lowercased scheme and host, sorted query """
+    parts = urlsplit(url if '//' in url else f'https://{url}')
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+class ResponseCache():
+    """ sqlite store of raw catalog responses with ttl expiry and size-based lru eviction """
+    def __init__(self, path, maxsize, ttl, negttl):
+        self.maxsize = maxsize # bytes
+        self.ttl = ttl # seconds
+        self.negttl = negttl # seconds, for responses with no records
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            content BLOB,
+            negative INTEGER,
+            stored REAL,
+            accessed REAL,
+            size INTEGER
+        )
+        """)
+        self.con.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.con.commit()
+        self.total = self.con.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url, ttl=None):
+        """ returns the cached body for url, or None if missing or expired """
+        key = normalize_url(url)
+        now = time.time()
+        with self.lock:
+            row = self.con.execute("SELECT content, negative, stored FROM responses WHERE url = ?", (key,)).fetchone()
+            if not row:
+                return None
+            content, negative, stored = row
+            if now - stored > (self.negttl if negative else (ttl or self.ttl)):
+                return None
+            self.con.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, key))
+            self.con.commit()
+        logger.debug(f'cache hit: {key}')
+        return content
+
+    def put(self, url, content, negative=False):
+        key = normalize_url(url)
+        now = time.time()
+        size = len(content)
+        with self.lock:
+            old = self.con.execute("SELECT size FROM responses WHERE url = ?", (key,)).fetchone()
+            self.con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, content, int(negative), now, now, size))
+            self.total += size - (old[0] if old else 0)
+            self.evict()
+            self.con.commit()
+
+    def evict(self):
+        """ drops least recently accessed responses until the cache fits in maxsize """
+        while self.total > self.maxsize:
+            rows = self.con.execute("SELECT url, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                self.total = 0
+                return
+            for url, size in rows:
+                self.con.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self.total -= size
+                if self.total <= self.maxsize:
+                    return
+
+class WorkCache():
+    """ sqlite store of open library works: which work each isbn belongs to, and per work
+    its search summary and edition list, so every edition of a work shares one fetch """
+    def __init__(self, path, ttl):
+        self.ttl = ttl # seconds
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("CREATE TABLE IF NOT EXISTS work_isbns (isbn TEXT PRIMARY KEY, work TEXT, stored REAL)")
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS works (
+            work TEXT,
+            kind TEXT,
+            data TEXT,
+            stored REAL,
+            PRIMARY KEY (work, kind)
+        )
+        """)
+        self.con.commit()
+
+    def get_work(self, isbn):
+        """ work key of isbn, or None if unknown or expired """
+        with self.lock:
+            row = self.con.execute("SELECT work, stored FROM work_isbns WHERE isbn = ?", (isbn,)).fetchone()
+        if not row or time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def put_work(self, work, isbns):
+        now = time.time()
+        with self.lock:
+            self.con.executemany("INSERT OR REPLACE INTO work_isbns VALUES (?, ?, ?)", [(i, work, now) for i in isbns])
+            self.con.commit()
+
+    def get(self, work, kind):
+        """ the work's 'summary' or 'editions', or None if missing or expired """
+        with self.lock:
+            row = self.con.execute("SELECT data, stored FROM works WHERE work = ? AND kind = ?", (work, kind)).fetchone()
+        if not row or time.time() - row[1] > self.ttl:
+            return None
+        logger.debug(f'work cache hit: {work} {kind}')
+        return json.loads(row[0])
+
+    def put(self, work, kind, data):
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?)", (work, kind, json.dumps(data), time.time()))
+            self.con.commit()
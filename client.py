@@ -0,0 +1,50 @@
+# !/usr/bin/env python
+
+import http.client
+import json
+import os
+import sys
+import tomllib
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+def get_port():
+    try:
+        with open(Path.home() / ".libcat" / "config.toml", "rb") as f:
+            return tomllib.load(f).get('serveport', 8765)
+    except (OSError, tomllib.TOMLDecodeError):
+        return 8765
+
+def main(argv):
+    """ sends argv to libcat serve as a job and prints its output. only the standard library is imported
+    so it starts fast; without a running server libcat itself is run """
+    if argv and argv[0] in ('db', 'serve'):
+        return fallback(argv)
+
+    request = json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8')
+    try:
+        r = urllib.request.urlopen(
+            urllib.request.Request(f"http://127.0.0.1:{get_port()}/job", request, {'Content-Type': 'application/json'})
+        )
+        result = json.loads(r.read())
+        output, status = result['output'], result['status']
+    except urllib.error.HTTPError as e:
+        # the server is up but refused the job, so running it here would hide why
+        sys.stderr.write(f"libcat serve refused the job: {e.code} {e.reason}\n")
+        return 1
+    except urllib.error.URLError:
+        return fallback(argv)
+    except (http.client.HTTPException, ConnectionError, ValueError, KeyError, TypeError) as e:
+        # the job may have run already, so it isn't run again here
+        sys.stderr.write(f"libcat serve gave no usable reply: {e!r}\n")
+        return 1
+    sys.stdout.write(output)
+    return status
+
+def fallback(argv):
+    libcat = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libcat.py')
+    os.execv(sys.executable, [sys.executable, libcat] + argv)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
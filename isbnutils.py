@@ -0,0 +1,53 @@
+# !/usr/bin/env python
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+def normalize(isbn) -> str:
+    """ leading isbn-like run of a string, without an 'isbn' label, separators or qualifiers like '(pbk.)' """
+    text = re.sub(r'^\s*isbn(?:-1[03])?:?\s*', '', str(isbn), flags=re.I)
+    run = re.match(r'[0-9Xx][0-9Xx\-– ]*', text)
+    return re.sub(r'[\-– ]', '', run.group(0)).upper() if run else ''
+
+def check_digit10(digits) -> str:
+    total = sum((10 - i) * int(d) for i, d in enumerate(digits[:9]))
+    check = (11 - total % 11) % 11
+    return 'X' if check == 10 else str(check)
+
+def check_digit13(digits) -> str:
+    total = sum((3 if i % 2 else 1) * int(d) for i, d in enumerate(digits[:12]))
+    return str((10 - total % 10) % 10)
+
+def is_valid(isbn) -> bool:
+    """ whether isbn is a normalized isbn-10 or isbn-13 with a correct check digit """
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        return isbn[9] == check_digit10(isbn)
+    if len(isbn) == 13 and isbn.isdigit() and isbn[:3] in ('978', '979'):
+        return isbn[12] == check_digit13(isbn)
+    return False
+
+def to_isbn13(isbn) -> str:
+    """ isbn-13 form of a valid normalized isbn """
+    if len(isbn) == 13:
+        return isbn
+    core = '978' + isbn[:9]
+    return core + check_digit13(core)
+
+def canonical(isbn) -> str or None:
+    """ isbn-13 of any written form of an isbn, or None if it is not a valid isbn """
+    isbn = normalize(isbn)
+    return to_isbn13(isbn) if is_valid(isbn) else None
+
+def dedupe(isbns, exclude=()) -> list:
+    """ canonical isbn-13s of isbns in their first order, dropping invalid ones, repeats of one edition and excluded isbns """
+    seen = {canonical(i) for i in exclude}
+    result = []
+    for i in isbns:
+        isbn = canonical(i)
+        if isbn and isbn not in seen:
+            seen.add(isbn)
+            result.append(isbn)
+    return result
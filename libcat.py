@@ -9,6 +9,15 @@ import sqlite3
 from sys import argv
 from pathlib import Path
 import shutil
+import threading
+import queue
+import io
+import json
+from contextlib import redirect_stdout, redirect_stderr
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 
 def get_user_data_dir():
     home = Path.home()
@@ -28,6 +37,9 @@ with open(CONFIG_FILE, "rb") as f:
 from match import match_lcc, match_isbn, match_ddc
 import scan
 import search
+import cache
+import isbnutils
+import throttle
 import dbviewer
 
 def search_catalogs(
@@ -41,40 +53,108 @@ def search_catalogs(
     id_type: str, 
     id_data: dict={}
 ) -> dict:
+    def query_catalog(catalog, _id, classifiers, cancel=None):
+        breaker = throttle.get_breaker(catalog)
+        if not breaker.allow():
+            logger.info(f"\t\t{catalog} circuit open, skipping")
+            return {}
+
+        cdict = CFG['catalogs'][catalog]
+        search_class = getattr(search, cdict['cclass'])
+        search_obj = search_class(wait, retries, timeout, _id, id_type, languages, classifiers, cdict)
+        if cancel: search_obj.cancel = cancel
+        try:
+            return search_obj.main()
+        finally:
+            if search_obj.answered or search_obj.failed:
+                breaker.record(not search_obj.failed)
+            else:
+                breaker.release()
+
+    def can_fill(catalog, classifiers):
+        """ the missing classifiers this catalog is able to supply """
+        caps = search.capabilities(CFG['catalogs'][catalog])
+        if languages and not caps['langfilter']:
+            return []
+        return [i for i in classifiers if i in caps['supplies']]
+
+    def merge(catalog, _id, search_result):
+        for k, v in search_result.items():
+            if v and not data[k]:
+                logger.info(f'\t\t{k} found')
+                data[k] = v
+                supp_data['catalog'] = catalog
+                supp_data[id_type] = _id
+
+                if k == 'record':
+                    supp_data['recordtype'] = CFG['catalogs'][catalog]['recordtype']
+
+    def fan_out(_id, currentalt=''):
+        """ queries all catalogs at once, merging results in catalog order """
+        classifiers = [k for k, v in data.items() if not v]
+        catalogs = [c for c in args.catalogs if can_fill(c, classifiers)]
+        if not catalogs:
+            return
+        logger.info(f"\tsearching {', '.join(catalogs)} catalogs with {_id} {currentalt} for {classifiers}")
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(catalogs))
+        futures = [executor.submit(query_catalog, c, _id, can_fill(c, classifiers), cancel) for c in catalogs]
+        try:
+            for catalog, future in zip(catalogs, futures):
+                merge(catalog, _id, future.result())
+
+                # return if data is full
+                if not any(i is None for i in data.values()):
+                    return True
+                if not currentalt: prefetch_alts(_id)
+        finally:
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def prefetch_alts(_id):
+        """ starts the alt isbn lookup in the background once a catalog has missed, see --prefetchalts """
+        nonlocal prefetch
+        if prefetch or args.prefetchalts != 'yes' or id_type != 'isbn' or altisbns != 'yes' or alt_isbns:
+            return
+        logger.info('\tprefetching alternative editions...')
+        search_obj = search.fetch_openl_alt(wait, retries, timeout, _id, id_type, languages, classifiers, None)
+        executor = ThreadPoolExecutor(max_workers=1)
+        prefetch = search_obj, executor.submit(search_obj.main)
+        executor.shutdown(wait=False)
+
     def process(_id, currentalt=''):
         nonlocal data
         nonlocal alt_isbns
         classifiers = [k for k, v in data.items() if not v]
 
-        for catalog in args.catalogs:
-            classifiers = [k for k, v in data.items() if not v]
-            logger.info(f"\tsearching {catalog} catalog with {_id} {currentalt} for {classifiers}")
-            cdict = CFG['catalogs'][catalog]
-            search_class = getattr(search, cdict['cclass'])
-            search_obj = search_class(wait, retries, timeout, _id, id_type, languages, classifiers, cdict)
-            search_result = search_obj.main()
-
-            for k, v in search_result.items():
-                if v and not data[k]:
-                    logger.info(f'\t\t{k} found')
-                    data[k] = v
-                    supp_data['catalog'] = catalog
-                    supp_data[id_type] = _id
-
-                    if k == 'record':
-                        supp_data['recordtype'] = cdict['recordtype']
-            
-            # return if data is full
-            if not any(i is None for i in data.values()):
+        if args.concurrent == 'yes':
+            if fan_out(_id, currentalt):
                 return True
+        else:
+            for catalog in args.catalogs:
+                classifiers = [k for k, v in data.items() if not v]
+                wanted = can_fill(catalog, classifiers)
+                if not wanted:
+                    logger.info(f"\tskipping {catalog} catalog: cannot supply {classifiers}")
+                    continue
+                logger.info(f"\tsearching {catalog} catalog with {_id} {currentalt} for {wanted}")
+                merge(catalog, _id, query_catalog(catalog, _id, wanted))
+
+                # return if data is full
+                if not any(i is None for i in data.values()):
+                    return True
+                if not currentalt: prefetch_alts(_id)
         
         # fetch alts
         if id_type == 'isbn' and altisbns == 'yes' and not alt_isbns:
             logger.info('\tfetching alternative editions...')
 
             
-            search_obj = search.fetch_openl_alt(wait, retries, timeout, _id, id_type, languages, classifiers, None)
-            alt_isbns, alt_lccs, alt_ddcs = search_obj.main()
+            if prefetch:
+                alt_isbns, alt_lccs, alt_ddcs = prefetch[1].result()
+            else:
+                search_obj = search.fetch_openl_alt(wait, retries, timeout, _id, id_type, languages, classifiers, None)
+                alt_isbns, alt_lccs, alt_ddcs = search_obj.main()
 
             if alt_lccs:
                 logging.info('\talt lccs found')
@@ -87,13 +167,24 @@ def search_catalogs(
                 return True
 
             print(alt_isbns, alt_lccs, alt_ddcs)
-            if languages and alt_isbns:
+            editions = {}
+            if alt_isbns and (languages or (args.rankalts == 'yes' and len(alt_isbns) > 1)):
                 search_obj = search.fetch_openl_alt_filtered(wait, retries, timeout, _id, id_type, languages, classifiers, None)
-                alt_isbns, _, _ = search_obj.main()
+                # ranking needs every edition, the alt loop below still stops at maxalts
+                filtered, _, _ = search_obj.main(None if args.rankalts == 'yes' else maxalts)
+                editions = search_obj.editions
+                if languages:
+                    alt_isbns = filtered
 
             if not alt_isbns:
                 logging.info('\tno alt isbns found')
                 return
+
+            if args.rankalts == 'yes':
+                alt_isbns = search.rank_alts(_id, alt_isbns, editions, languages, HIT_RATES)
+                logger.debug(f'\tranked alt isbns: {alt_isbns}')
+
+            search.plan_batches([CFG['catalogs'][c] for c in args.catalogs], alt_isbns[:maxalts])
             
             # loop through alts
             for idi, i in enumerate(alt_isbns):
@@ -113,94 +204,282 @@ def search_catalogs(
         else: supp_data[k] = v
 
     alt_isbns = []
+    prefetch = None # (fetch_openl_alt, future) started by prefetch_alts
     
     if id_type and any(i is None for i in data.values()):
         _id = id_data[id_type]
-        process(_id)
+        if id_type == 'isbn' and not isbnutils.canonical(_id):
+            logger.info(f'\t{_id} is not a valid isbn, not searching')
+        else:
+            process(_id)
+
+    # primary catalogs filled everything, the alt lookup is not needed
+    if prefetch and not prefetch[1].done():
+        prefetch[0].cancel.set()
+        prefetch[1].cancel()
 
     final_data = {**supp_data, **data}
 
-    logger.log(STDINFO, '\n'.join(f'{k}{" "*(20-len(k))}{v}' for k, v in final_data.items() if k != 'record'))
+    log_data(final_data)
     return final_data
 
-def parse_file(file: str, parsefor: list, parseall: str) -> dict:
-    parsed = {}
-    for i in parsefor:
-        parsed_id = scan.main(file, getattr(scan, f'match_{i}'))
-        parsed[i] = parsed_id
-        if parsed_id:
-            logger.info(f'{i} found in file')
-            if parseall == 'no':
-                return parsed
+def log_data(data: dict):
+    logger.log(STDINFO, '\n'.join(f'{k}{" "*(20-len(k))}{v}' for k, v in data.items() if k != 'record'))
+
+def log_throttle():
+    report = throttle.breaker_report()
+    if report:
+        logger.log(STDINFO, f'\ncatalog circuits tripped during this job:\n{report}')
+    report = throttle.rate_report()
+    if report:
+        logger.info(f'\nrate limiter waits:\n{report}')
+
+def prefix_hit_rates(cur, length: int) -> dict:
+    """ share of earlier isbn lookups that found a catalog record, per isbn-13 prefix of length digits """
+    rows = cur.execute(
+        "SELECT substr(isbn, 1, ?), COUNT(catalog), COUNT(*) FROM jobs WHERE length(isbn) = 13 GROUP BY 1",
+        (length,)
+    )
+    return {prefix: (hits + 1) / (total + 2) for prefix, hits, total in rows}
+
+def reuse_isbn(cur, isbn, classifiers: list, maxage: int) -> dict:
+    """ data of the latest job within maxage days that already has every classifier for isbn """
+    columns = ['catalog', 'isbn', 'recordtype'] + [i for i in classifiers if i != 'isbn']
+    filled = ' AND '.join(f'{i} IS NOT NULL' for i in classifiers)
+    row = cur.execute(
+        f"SELECT id, {', '.join(columns)} FROM jobs WHERE isbn = ? AND timestamp >= datetime('now', ?) AND {filled} ORDER BY id DESC LIMIT 1",
+        (str(isbn), f'-{maxage} days')
+    ).fetchone()
+    if not row:
+        return None
+
+    logger.info(f'\t{isbn} already resolved in job {row[0]}, reusing')
+    data = dict(zip(columns, row[1:]))
+    log_data(data)
+    return data
+
+def parse_file(file: str, parsefor: list, parseall: str, pool=None) -> tuple:
+    """ (identifiers parsed from file, parse status), in a worker of pool when given so the parse can be
+    stopped after parsetimeout seconds """
+    if pool:
+        return pool.scan_file(file, parsefor, parseall, timeout=CFG.get('parsetimeout', 60))
+    return scan.scan_file(file, parsefor, parseall)
+
+def log_parsed(parsed: dict):
+    for i, parsed_id in parsed.items():
+        if parsed_id: logger.info(f'{i} found in file')
         else: logger.info(f'{i} not found in file')
-    return parsed
     
+def pipeline(func, items, jobs=1, executor=None):
+    """ runs func over items with at most `jobs` in flight, yielding results in input order.
+    uses a thread pool of `jobs` unless an executor, e.g. a process pool, is given """
+    own = executor is None
+    if own:
+        executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        inflight = deque()
+        for item in items:
+            inflight.append(executor.submit(func, item))
+            if len(inflight) >= jobs:
+                yield inflight.popleft().result()
+        while inflight:
+            yield inflight.popleft().result()
+    finally:
+        if own:
+            executor.shutdown()
+
+def run_ahead(items, size):
+    """ iterates items on a thread of its own, keeping up to `size` results ready ahead of the consumer.
+    an exception raised by items is re-raised to the consumer """
+    results = queue.Queue(maxsize=max(1, size))
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            item, error = results.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        feeder.join()
+
 def do_job(args, cur):
+    def insert_job(jobtype, data, parentid=None, file_or_dir=None, fullpath=None):
+        columns = ('jobtype', 'parentid') + tuple(data.keys())
+        values = (jobtype, parentid) + tuple(data.values())
+        if file_or_dir:
+            columns += ('file_or_dir', 'fullpath')
+            values += (file_or_dir, fullpath)
+
+        placeholders = ', '.join('?' for _ in columns)
+        cur.execute(f"INSERT INTO jobs {columns} VALUES ({placeholders})", values)
+        cur.execute("COMMIT")
+
     def do_directory(directory):
         cur.execute("INSERT INTO jobs (jobtype, file_or_dir) VALUES (?, ?)", ('dir_marker', directory))
         parentid = cur.execute("SELECT id FROM jobs WHERE rowid = (SELECT MAX(rowid) FROM jobs)").fetchone()[0]
-        count = 1
+
+        # skip files already in the DB (or seen twice in this run) before any work is queued
+        seen = {i[0] for i in cur.execute(SEEN_FILES, RETRY_STATUSES).fetchall()}
+        fpaths = []
         for subdir, dirs, files in os.walk(directory):
-            files = [f for f in files if (f.endswith(i) for i in args.filetypes)]
+            dirs.sort()
+            files = [f for f in sorted(files) if any(f.endswith(i) for i in args.filetypes)]
             for f in files:
-                logger.info(f"-------------------- \n [{count}]: {f}")
-                fpath = os.path.join(subdir, f)
-                logger.debug('file path: ', fpath)
-                do_file(fpath, parentid)
-                count += 1
-
-        query = f"SELECT file_or_dir, catalog, lcc, ddc FROM jobs WHERE parentid = {parentid}"
+                if f in seen:
+                    logger.info(f'{f} already in DB, skipping..')
+                    continue
+                seen.add(f)
+                fpaths.append(os.path.abspath(os.path.join(subdir, f)))
+
+        # text extraction is cpu-bound, so with --parse-workers it runs in several worker processes
+        pool = scan_pool(args.parse_workers)
+
+        def scan_work(fpath):
+            return parse_file(fpath, args.parsefor, args.parseall, pool)
+
+        # files are searched a window at a time so isbns parsed from them can be batched; scanning runs
+        # ahead on its own thread so parse workers keep busy while a window is searched
+        window = CFG.get('batchsize', 10) * max(1, args.jobs)
+        scanned = run_ahead(pipeline(scan_work, fpaths, max(args.parse_workers, args.jobs)), window)
+
+        def parse_work():
+            for count, (fpath, result) in enumerate(zip(fpaths, scanned), 1):
+                logger.info(f"-------------------- \n [{count}]: {os.path.basename(fpath)}")
+                logger.debug(f'file path: {fpath}')
+                yield fpath, check_parsed(*result)
+
+        parsed_files = parse_work()
+        try:
+            while chunk := list(islice(parsed_files, window)):
+                plan_batches([parsed.get('isbn') for _, (parsed, _) in chunk if parsed and parsed.get('isbn')])
+                for (fpath, (parsed, status)), data in zip(chunk, pipeline(search_data, [parsed for _, (parsed, _) in chunk], args.jobs)):
+                    if data or status != 'ok':
+                        insert_job('dir_file', {**(data or {}), 'parsestatus': status}, parentid, os.path.basename(fpath), fpath)
+        finally:
+            scanned.close()
+            search.BATCHES.clear()
+            if pool:
+                pool.close()
+
+        query = f"SELECT file_or_dir, catalog, lcc, ddc, parsestatus FROM jobs WHERE parentid = {parentid} ORDER BY id"
         logger.log(STDINFO, '===============\n    SUMMARY    \n===============')
         dbviewer.print_sql_query(query, cur)     
+        log_throttle()
 
-    def do_file(file, parentid=None):
-        fullpath = os.path.abspath(file)
-        basepath = os.path.basename(fullpath)
+    def plan_batches(isbns):
+        search.plan_batches([CFG['catalogs'][c] for c in args.catalogs], isbns)
 
-        for i in cur.execute("SELECT file_or_dir FROM jobs").fetchall():
-            if basepath == i[0]: 
-                logger.info('already in DB, skipping..')
-                return
+    def scan_pool(size=1):
+        """ worker processes parsing files, so a parse can be stopped after parsetimeout; None parses in this process """
+        if size > 1 or CFG.get('parsetimeout', 60):
+            return scan.ScanPool(size)
 
-        parsed = parse_file(fullpath, args.parsefor, args.parseall)
+    def parse_data(fullpath, pool=None):
+        return check_parsed(*parse_file(fullpath, args.parsefor, args.parseall, pool))
+
+    def check_parsed(parsed, status):
+        """ (parsed identifiers or None if there are none, parse status) """
+        log_parsed(parsed)
         logger.debug(parsed)
 
         if all(i is None for i in parsed.values()):
             logger.info('no identifiers found in file')
+            return None, status
+        if parsed.get('isbn'):
+            parsed['isbn'] = isbnutils.canonical(parsed['isbn'])
+        return parsed, status
+
+    def search_data(parsed):
+        if not parsed:
             return
 
         def get_at(lst, idx):
             return lst[idx] if idx < len(lst) else None
         
         id_type = get_at([i for i in parsed if i not in ('lcc', 'ddc') and parsed[i]], 0)
-        data = search_catalogs(args.wait, args.retries, args.timeout, args.languages, args.altisbns, args.maxalts, args.classifiers, id_type, parsed)
-        
-        columns = ('jobtype', 'file_or_dir', 'fullpath', 'parentid') + tuple(k for k in data.keys())
-        jobtype = {True: 'dir_file', False: 'file'}
-        values = (jobtype[bool(parentid)], basepath, fullpath, parentid) + tuple(v for v in data.values())
+        return search_catalogs(args.wait, args.retries, args.timeout, args.languages, args.altisbns, args.maxalts, args.classifiers, id_type, parsed)
 
-        placeholders = ', '.join('?' for _ in columns)
-        cur.execute(f"INSERT INTO jobs {columns} VALUES ({placeholders})", values)
-        cur.execute("COMMIT")
+    def do_file(file):
+        fullpath = os.path.abspath(file)
+        basepath = os.path.basename(fullpath)
 
-    def do_isbn(isbn, parentid=None):
-        data = search_catalogs(args.wait, args.retries, args.timeout, args.languages, args.altisbns, args.maxalts, args.classifiers, 'isbn', {'isbn': isbn})
-        columns = ('jobtype', 'parentid') + tuple(k for k in data.keys())
-        jobtype = {True: 'list_isbn', False: 'isbn'}
-        values = (jobtype[bool(parentid)], parentid) + tuple(v for v in data.values())
+        for i in cur.execute(SEEN_FILES, RETRY_STATUSES).fetchall():
+            if basepath == i[0]: 
+                logger.info('already in DB, skipping..')
+                return
 
-        placeholders = ', '.join('?' for _ in columns)
-        cur.execute(f"INSERT INTO jobs {columns} VALUES ({placeholders})", values)
-        cur.execute("COMMIT")
+        pool = scan_pool()
+        try:
+            parsed, status = parse_data(fullpath, pool)
+        finally:
+            if pool:
+                pool.close()
+        data = search_data(parsed)
+        if data or status != 'ok':
+            insert_job('file', {**(data or {}), 'parsestatus': status}, None, basepath, fullpath)
+
+    def isbn_data(isbn):
+        return search_catalogs(args.wait, args.retries, args.timeout, args.languages, args.altisbns, args.maxalts, args.classifiers, 'isbn', {'isbn': isbn})
 
-    def do_isbn_list(self, list_file):
+    def prior_data(isbn):
+        if args.refresh:
+            return None
+        return reuse_isbn(cur, isbn, args.classifiers, CFG.get('reusemaxage', 90))
+
+    def do_isbn(isbn):
+        insert_job('isbn', prior_data(isbn) or isbn_data(isbn))
+
+    def do_isbn_list(list_file):
         cur.execute("INSERT INTO jobs (jobtype, file_or_dir) VALUES (?, ?)", ('isbn_list', list_file))
         parentid = cur.execute("SELECT id FROM jobs WHERE rowid = (SELECT MAX(rowid) FROM jobs)").fetchone()[0]
 
+        isbns = []
         with open(list_file) as f:
             for line in f:
-                isbn = line.replace('-', '').strip()
-                do_isbn(isbn, parentid)
+                if not line.strip():
+                    continue
+                isbn = isbnutils.canonical(line)
+                if isbn:
+                    isbns.append(isbn)
+                else:
+                    logger.info(f'{line.strip()} is not a valid isbn, skipping..')
+
+        # earlier jobs are looked up here since only this thread uses the cursor
+        items = [(isbn, prior_data(isbn)) for isbn in isbns]
+        plan_batches([isbn for isbn, prior in items if not prior])
+
+        for data in pipeline(lambda item: item[1] or isbn_data(item[0]), items, args.jobs):
+            insert_job('list_isbn', data, parentid)
+        search.BATCHES.clear()
+        log_throttle()
 
     if os.path.isdir(args.input):
         do_directory(args.input)
@@ -215,18 +494,16 @@ def do_job(args, cur):
             logger.info(f"no files of type {args.filetypes}, txt")
         return
 
-    try: 
-        isbn = int(args.input.replace('-', ''))
-    except ValueError:
-        logger.info("please provide a file, directory, or isbn")
-        return
-    else:
-        do_isbn(isbn)
+    isbn = isbnutils.canonical(args.input)
+    if not isbn:
+        logger.info("please provide a file, directory, or valid isbn")
         return
+    do_isbn(isbn)
 
 
-def main():
-    con = sqlite3.connect(DATA_DIR / "libcat.db")
+def setup():
+    """ opens the jobs database and the caches, returning a cursor """
+    con = sqlite3.connect(DATA_DIR / "libcat.db", check_same_thread=False)
     cur = con.cursor()
 
     cur.execute("""
@@ -243,24 +520,133 @@ def main():
         lcc TEXT,
         ddc TEXT,
         lcsh TEXT,
-        recordtype TEXT
+        recordtype TEXT,
+        parsestatus TEXT
     )
     """)
+    # databases from before parsestatus
+    if 'parsestatus' not in [i[1] for i in cur.execute("PRAGMA table_info(jobs)")]:
+        cur.execute("ALTER TABLE jobs ADD COLUMN parsestatus TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS jobs_isbn ON jobs (isbn)")
+
+    search.CACHE = cache.ResponseCache(
+        DATA_DIR / "cache.db",
+        CFG.get('cachesize', 200) * 2**20,
+        CFG.get('cachettl', 30) * 86400,
+        CFG.get('cachenegttl', 1) * 86400,
+    )
+    search.WORKS = cache.WorkCache(DATA_DIR / "cache.db", CFG.get('workttl', 30) * 86400)
+    return cur
+
+def run(cur):
+    """ one job for the global args """
+    logger.setLevel(max(0, 25 - args.verbose * 10))
+    search.OFFLINE = args.offline
+    HIT_RATES.clear()
+    HIT_RATES.update(prefix_hit_rates(cur, CFG.get('rankprefix', 8)))
+    try:
+        do_job(args, cur)
+    finally:
+        search.BATCHES.clear()
 
-    do_job(args, cur)
+def main():
+    run(setup())
+
+def serve(argv):
+    """ keeps caches, connection pools and the database open, running jobs sent to a localhost http endpoint.
+    a job is a json {"argv": [...], "cwd": ...} posted to /job, answered with its output and new job rows """
+    serve_parser = argparse.ArgumentParser(prog="LibCat serve")
+    serve_parser.add_argument('-p', "--port", type=int, default=CFG.get('serveport', 8765), help="port to listen on at 127.0.0.1")
+    port = serve_parser.parse_args(argv).port
+
+    cur = setup()
+    job_lock = threading.Lock() # jobs share the global args, so one runs at a time
+
+    def run_job(request):
+        global args
+        output = io.StringIO()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        with job_lock:
+            lastid = cur.execute("SELECT COALESCE(MAX(id), 0) FROM jobs").fetchone()[0]
+            cwd = os.getcwd()
+            logging.getLogger().addHandler(handler)
+            status = 0
+            try:
+                os.chdir(request.get('cwd') or cwd)
+                with redirect_stdout(output), redirect_stderr(output):
+                    try:
+                        args = build_parser().parse_args(request.get('argv', []))
+                        run(cur)
+                    except SystemExit as e:
+                        status = e.code if isinstance(e.code, int) else 1
+                    except Exception as e:
+                        logger.exception(e)
+                        status = 1
+            finally:
+                logging.getLogger().removeHandler(handler)
+                os.chdir(cwd)
+            cur.execute("SELECT * FROM jobs WHERE id > ? ORDER BY id", (lastid,))
+            columns = [i[0] for i in cur.description]
+            # records are kept as the raw response blob, which json can't carry
+            jobs = [{c: v.decode('utf-8', 'replace') if isinstance(v, bytes) else v for c, v in zip(columns, row)}
+                    for row in cur.fetchall()]
+        return {'status': status, 'output': output.getvalue(), 'jobs': jobs}
+
+    class JobHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/job':
+                self.send_error(404)
+                return
+            # a web page can post to localhost too, but not with a json content type or its own host name
+            host = (self.headers.get('Host') or '').rsplit(':', 1)[0]
+            if host not in ('127.0.0.1', 'localhost'):
+                self.send_error(403, 'jobs are only taken on 127.0.0.1 or localhost')
+                return
+            if (self.headers.get('Content-Type') or '').split(';')[0].strip().lower() != 'application/json':
+                self.send_error(415, 'job must be sent as application/json')
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self.send_error(400, 'job must be json')
+                return
+            if (not isinstance(request, dict) or not isinstance(request.get('argv', []), list)
+                    or not all(isinstance(i, str) for i in request.get('argv', []))
+                    or not isinstance(request.get('cwd') or '', str)):
+                self.send_error(400, 'job must be an object with an argv list of strings and a cwd string')
+                return
+            body = json.dumps(run_job(request)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *a):
+            logger.debug(format % a)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), JobHandler)
+    logger.log(STDINFO, f'libcat serving on http://127.0.0.1:{port}/job')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 logger = logging.getLogger(__name__)
 STDINFO = 25
+HIT_RATES = {} # isbn prefix -> share of earlier lookups with a catalog hit, for ranking alt isbns
+RETRY_STATUSES = ('timeout', 'error') # parses that may work on a later run, so their files aren't skipped
+SEEN_FILES = "SELECT file_or_dir FROM jobs WHERE parsestatus IS NULL OR parsestatus NOT IN (?, ?)"
 logging.addLevelName(STDINFO, "STDINFO")
 
 logging.basicConfig(level=25, format='%(message)s')
 
 
-if __name__ == '__main__':
-    if len(argv) > 1 and argv[1] == 'db':
-        dbviewer.main(argv[2:])
-        exit()
-
+def build_parser():
+    """ the main options, also used to read jobs sent to libcat serve """
     class CustomHelpFormatter(argparse.HelpFormatter):
         def _format_action_invocation(self, action):
             if not action.option_strings or action.nargs == 0:
@@ -282,17 +668,32 @@ if __name__ == '__main__':
     parser.add_argument('-pf', "--parsefor", metavar='<identifier>', nargs='+', choices=['lcc', 'lccn', 'isbn', 'ddc'], default=CFG['parsefor'], help="the identifiers to parse for in the file before searching catalogs")
     parser.add_argument('-pa', "--parseall", choices=['yes', 'no'], default=CFG['parseall'], help="extract all ids in parsefor from file as opposed to moving on with first id found")
     parser.add_argument('-c', "--catalogs", metavar='<shortcode>', nargs='+', choices=CFG['catalogs'].keys(), default=CFG['order'], help=f"the catalogs to use and order in which they are searched: {list(CFG['catalogs'].keys())}")
-    parser.add_argument('-w', "--wait", type=int, metavar='<seconds>', default=CFG['wait'], help="number of seconds to wait after a failed request before retrying") # convert to float after
+    parser.add_argument('-cc', "--concurrent", choices=['yes', 'no'], default=CFG.get('concurrent', 'no'), help="query all catalogs for an isbn at once, keeping the catalog order for results")
+    parser.add_argument('-j', "--jobs", type=int, metavar='<count>', default=CFG.get('jobs', 1), help="number of isbns or files from a list or directory processed at once")
+    parser.add_argument('-pw', "--parse-workers", type=int, metavar='<count>', default=CFG.get('parseworkers', 1), help="number of processes parsing files from a directory at once, each stopped after parsetimeout seconds on a file")
+    parser.add_argument('-w', "--wait", type=int, metavar='<seconds>', default=CFG['wait'], help="base number of seconds to wait after a failed request before retrying; doubles with each retry") # convert to float after
     parser.add_argument('-r', "--retries", type=int, metavar='<count>', default=CFG['retries'], help="number of retries when a request fails")
     parser.add_argument("--timeout", type=int, metavar='<seconds>', default=CFG['timeout'], help="number of seconds to wait for a response from server") # convert to float after
     parser.add_argument('-cl', "--classifiers", nargs='+', choices=['record', 'lcc', 'ddc', 'lcsh', 'isbn'], default=CFG['classifiers'], help="classifiers to retrieve from catalogs")
     parser.add_argument('-alt', "--altisbns", choices=['yes', 'no'], default=CFG['altisbns'], help="if original isbn returns no results, try using a work's alternative isbns")
+    parser.add_argument('-pre', "--prefetchalts", choices=['yes', 'no'], default=CFG.get('prefetchalts', 'no'), help="look up alternative isbns in the background once the first catalog misses, in case they are needed")
+    parser.add_argument('-ra', "--rankalts", choices=['yes', 'no'], default=CFG.get('rankalts', 'yes'), help="try the alternative isbns most likely to be in catalogs first")
     parser.add_argument('-ma', "--maxalts", metavar="<count>", type=int, default=50, help="maximum number of alternative isbns to consider before aborting")
+    parser.add_argument("--refresh", action='store_true', help="search catalogs even for isbns already resolved in an earlier job")
+    parser.add_argument("--offline", action='store_true', help="answer only from cached catalog responses, without network requests")
     parser.add_argument('-v', '--verbose', action='count', default=0, help="verbosity of logging. -v: info, -vv: debug")
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.0')
+    return parser
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == 'db':
+        dbviewer.main(argv[2:])
+        exit()
 
-    args = parser.parse_args()
+    if len(argv) > 1 and argv[1] == 'serve':
+        serve(argv[2:])
+        exit()
 
-    logger.setLevel(max(0, 25 - args.verbose * 10))
+    args = build_parser().parse_args()
 
     main()
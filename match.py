@@ -1,36 +1,27 @@
 # !/usr/bin/env python
 
 import regex as re
+import isbnutils
 
-def match_lcc(x):
-    a = re.compile(r"""
-            (?P<class>(\b)([A-Z](?:\s?)){1,3}) # main and sub class
-            (?P<div>\d{1,4}) # subclass division
-            (?P<ext>.\d{1,3})? # optional subclass division extensionl
-            (?P<date>[A-Za-z0-9]{1,4})? #what?
-            (\s?[\s\.](?P<c1>[A-Z][0-9]{1,4})) # cutter number, added ?
-            (\ (?P<c1d>[A-Za-z0-9]{0,4}))?
-            (\.?(?P<c2>[A-Z][0-9]{1,4}))?
-            (\ (?P<e8>\w*)\ ?)?
-            (\ (?P<e9>\w*)\ ?)?
-            (\ (?P<e10>\w*)\ ?)?
-            """, re.VERBOSE)
-
-    if a.search(x):
-        result = a.search(x).group(0)
-        result = re.sub(r"(?<=[A-Z])\s", '', result)
-        return result
-    else: return None
+# patterns are compiled once at import; none of them look behind, so matching stays linear in the text
 
-def match_ddc(x):
-    a = re.compile(r"(\d{3}['′]?\.[\d'′ ]*[-–—]{1,2}dc\s?2[12])")
+LCC = re.compile(r"""
+        (?P<class>(\b)([A-Z](?:\s?)){1,3}) # main and sub class
+        (?P<div>\d{1,4}) # subclass division
+        (?P<ext>.\d{1,3})? # optional subclass division extensionl
+        (?P<date>[A-Za-z0-9]{1,4})? #what?
+        (\s?[\s\.](?P<c1>[A-Z][0-9]{1,4})) # cutter number, added ?
+        (\ (?P<c1d>[A-Za-z0-9]{0,4}))?
+        (\.?(?P<c2>[A-Z][0-9]{1,4}))?
+        (\ (?P<e8>\w*)\ ?)?
+        (\ (?P<e9>\w*)\ ?)?
+        (\ (?P<e10>\w*)\ ?)?
+        """, re.VERBOSE)
+LCC_SPACE = re.compile(r"(?<=[A-Z])\s")
 
-    result = a.search(x)
-    return result.group(0).strip() if result else None
+DDC = re.compile(r"(\d{3}['′]?\.[\d'′ ]*[-–—]{1,2}dc\s?2[12])")
 
-def match_isbn(x):
-    isbn13 = re.compile(r"""
-    (?<=(ISBN|isbn)(.*))?
+ISBN13 = re.compile(r"""
     (978|979) [-– ]?
     (?P<reggrp>\d{1,5}) [-– ]?
     (?P<registrant>\d{0,7}) [-– ]?
@@ -38,19 +29,65 @@ def match_isbn(x):
     (?P<chkdig>\d|X|x)
     """, re.VERBOSE)
 
-    isbn10 = re.compile(r"""
-    (?<=(ISBN|isbn)(.*))
+# only searched on a line after an isbn label, see isbn10_matches
+ISBN10 = re.compile(r"""
     (?P<country>\d{1,5}) [-– ]?
     (?P<pub>\d{1,7}) [-– ]?
     (?P<title>\d{1,6}) [-– ]?
     (?P<chkdig>\d|X|x) [-– ]?
     """, re.VERBOSE)
+ISBN_LABEL = re.compile(r"ISBN|isbn")
+ISBN_SEP = re.compile('[-– ]')
 
-    result = isbn13.search(x) or isbn10.search(x)
-    return re.sub('[-– ]', '', result.group(0)) if result and (len(result) >= 10) else None
+ISSN = re.compile(r'[0-9]{4}-[0-9]{3}[0-9X]')
 
-def match_issn(x):
-    issn = re.compile(r'[0-9]{4}-[0-9]{3}[0-9X]')
+def lcc_matches(x):
+    for result in LCC.finditer(x):
+        yield result.start(), result.end(), LCC_SPACE.sub('', result.group(0))
+
+def ddc_matches(x):
+    for result in DDC.finditer(x):
+        yield result.start(), result.end(), result.group(0).strip()
+
+def isbn10_matches(x):
+    """ isbn-10 candidates anywhere after the first isbn label of a line """
+    pos = 0
+    while label := ISBN_LABEL.search(x, pos):
+        end = x.find('\n', label.end())
+        end = len(x) if end == -1 else end
+        yield from ISBN10.finditer(x, label.end(), end)
+        pos = end
+
+def isbn_matches(x):
+    """ isbn-13 then isbn-10 candidates with a valid check digit """
+    for pattern in (ISBN13.finditer(x), isbn10_matches(x)):
+        for result in pattern:
+            isbn = ISBN_SEP.sub('', result.group(0)).upper()
+            if isbnutils.is_valid(isbn):
+                yield result.start(), result.end(), isbn
+
+def issn_matches(x):
+    for result in ISSN.finditer(x):
+        yield result.start(), result.end(), result.group(0)
+
+MATCHES = {'lcc': lcc_matches, 'ddc': ddc_matches, 'isbn': isbn_matches, 'issn': issn_matches}
 
-    result = issn.search(x)
-    return result.group(0) if result else None
\ No newline at end of file
+def scan_all(x, ids=None) -> list:
+    """ every match of each identifier in ids (default all) as (id, start, end, value), ordered by position """
+    found = [(i, start, end, value) for i in (ids or MATCHES) for start, end, value in MATCHES[i](x)]
+    return sorted(found, key=lambda m: (m[1], m[2]))
+
+def first(matches):
+    return next((value for _, _, value in matches), None)
+
+def match_lcc(x):
+    return first(lcc_matches(x))
+
+def match_ddc(x):
+    return first(ddc_matches(x))
+
+def match_isbn(x):
+    return first(isbn_matches(x))
+
+def match_issn(x):
+    return first(issn_matches(x))
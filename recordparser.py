@@ -2,6 +2,7 @@
 
 import logging
 from selectolax.lexbor import LexborHTMLParser
+from xml.parsers import expat
 import json
 
 logger = logging.getLogger(__name__)
@@ -31,116 +32,232 @@ def tidy(text, a=0):
 def to_str(items, delim):
     return delim.join(i for i in items) if isinstance(items, list) else items
 
+class MarcField():
+    """ a datafield or controlfield: its indicators, (code, text) subfields and full text """
+    __slots__ = ('tag', 'ind1', 'ind2', 'subfields', 'text')
+
+    def __init__(self, tag, ind1='', ind2=''):
+        self.tag = tag
+        self.ind1 = ind1
+        self.ind2 = ind2
+        self.subfields = []
+        self.text = ''
+
+    def get(self, codes, first=True):
+        texts = [t for c, t in self.subfields if c in codes]
+        return get_at(texts, 0) if first else texts
+
+MARC_NS = ('', 'http://www.loc.gov/MARC21/slim')
+META = ('numberOfRecords', 'message', 'title') # sru record count, sru diagnostic, html error page title
+
+class MarcIndexer():
+    """ expat handlers filing every element with a tag attribute under its tag, without building a tree.
+    keeps the byte span of each marc record so a multi-record response can be split """
+    def __init__(self, parser):
+        self.parser = parser
+        self.fields = {} # every record's fields, tag -> [MarcField]
+        self.records = [] # (start, end, fields) per marc record
+        self.meta = {}
+        self.record = None # (start, fields) of the record being read
+        self.field = None # (element name, MarcField) being read
+        self.code = None # (element name, code) of the subfield being read
+        self.metaname = None
+        self.text = []
+        self.subtext = []
+
+    def start(self, name, attrs):
+        ns, _, local = name.rpartition('}')
+        if local == 'record' and ns in MARC_NS and self.record is None:
+            self.record = self.parser.CurrentByteIndex, {}
+        elif local in META and local not in self.meta and self.field is None:
+            self.metaname = name
+            self.text = []
+        elif self.field is None and 'tag' in attrs:
+            self.field = name, MarcField(attrs['tag'], attrs.get('ind1', ''), attrs.get('ind2', ''))
+            self.text = []
+        elif self.field is not None and self.code is None and 'code' in attrs:
+            self.code = name, attrs['code']
+            self.subtext = []
+
+    def end(self, name):
+        if self.code is not None and name == self.code[0]:
+            self.field[1].subfields.append((self.code[1], ''.join(self.subtext)))
+            self.code = None
+        elif self.field is not None and name == self.field[0]:
+            field = self.field[1]
+            field.text = ''.join(self.text)
+            self.fields.setdefault(field.tag, []).append(field)
+            if self.record:
+                self.record[1].setdefault(field.tag, []).append(field)
+            self.field = None
+        elif name == self.metaname:
+            self.meta[name.rpartition('}')[2]] = ''.join(self.text).strip()
+            self.metaname = None
+        elif self.record and name.rpartition('}')[2] == 'record':
+            self.records.append((self.record[0], self.parser.CurrentByteIndex, self.record[1]))
+            self.record = None
+
+    def data(self, text):
+        if self.field is not None or self.metaname:
+            self.text.append(text)
+            if self.code is not None:
+                self.subtext.append(text)
+
+def index_marcxml(marcxml) -> tuple:
+    """ one streaming pass over the xml, returning
+    (tag -> [MarcField] in document order, [(record xml, its fields)], {sru/html meta: text}).
+    input that is not well-formed xml falls back to the lenient html parser """
+    data = marcxml.lstrip()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+        parser = expat.ParserCreate('utf-8', namespace_separator='}')
+    else:
+        parser = expat.ParserCreate(namespace_separator='}')
+    indexer = MarcIndexer(parser)
+    parser.StartElementHandler = indexer.start
+    parser.EndElementHandler = indexer.end
+    parser.CharacterDataHandler = indexer.data
+    parser.buffer_text = True
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError:
+        logger.debug('malformed marcxml, parsing as html')
+    else:
+        records = []
+        for start, end, fields in indexer.records:
+            raw = data[start:data.index(b'>', end) + 1]
+            records.append((raw.decode('utf-8') if isinstance(marcxml, str) else raw, fields))
+        return indexer.fields, records, indexer.meta
+
+    def index_nodes(nodes):
+        fields = {}
+        for node in nodes:
+            attrs = node.attributes
+            field = MarcField(attrs['tag'], attrs.get('ind1') or '', attrs.get('ind2') or '')
+            field.subfields = [(i.attributes['code'], i.text()) for i in node.css('[code]')]
+            field.text = node.text()
+            fields.setdefault(field.tag, []).append(field)
+        return fields
+
+    tree = LexborHTMLParser(marcxml)
+    records = [(node.html, index_nodes(node.css('[tag]'))) for node in tree.css('record')]
+    meta = {}
+    for i in META:
+        node = tree.css_first(f'zs\\:{i}, {i}')
+        if node: meta[i] = node.text().strip()
+    return index_nodes(tree.css('[tag]')), records, meta
+
 class marcxml_record():
-    def __init__(self, marcxml):
+    def __init__(self, marcxml, fields=None):
         self.marcxml = marcxml
-        self.tree = LexborHTMLParser(marcxml)
-
-    def get_field(self, tree=None, tag='', ind1='', ind2='', codes=(), first=True):
-        if not tree: tree = self.tree
-
-        dattrs = [('tag', tag), ('ind1', ind1), ('ind2', ind2)]
-        datafield = ''.join(f'[{a}="{v}"]' for a, v in dattrs if v)
-        subfields = f""":is({','.join(f'[code="{c}"]' for c in codes)})""" if codes else None
-        selector = ' > '.join(i for i in (datafield, subfields) if i)
-        # selector = '[tag="650"]'
-        logger.debug('css selector:', selector)   
-
-        result = tree.css_first(selector) if first else tree.css(selector)
-        # print(type(result))
-        return result
-
+        if fields is None:
+            self.fields, self.records, self.meta = index_marcxml(marcxml)
+        else:
+            self.fields, self.records, self.meta = fields, [], {}
+
+    def split(self) -> list:
+        """ a marcxml_record per marc record in a multi-record response, each holding its own xml """
+        if not self.records:
+            return [self]
+        return [marcxml_record(raw, fields) for raw, fields in self.records]
+
+    def get_field(self, tag, ind1='', ind2='', first=True):
+        fields = [i for i in self.fields.get(tag, ()) if (not ind1 or i.ind1 == ind1) and (not ind2 or i.ind2 == ind2)]
+        return get_at(fields, 0) if first else fields
+
+    def get_subfield(self, tags, codes, first=True):
+        """ text of the subfields in codes of every field with tag, in document order.
+        tags may be a tuple of fallbacks, the first with a match wins """
+        for tag in (tags if isinstance(tags, tuple) else (tags,)):
+            texts = [t for field in self.fields.get(tag, ()) for t in field.get(codes, first=False)]
+            if texts:
+                return texts[0] if first else texts
+        return None if first else []
 
     def get_record(self):
         return self.marcxml
 
     def get_title(self, split=False):
-        title = self.get_field(tag='245', codes=('a', 'b'), first=False)
+        title = self.get_subfield('245', ('a', 'b'), first=False)
 
         if split:
             titlea = get_at(title, 0)
             titleb = get_at(title, 1)
-            return tidy(titlea.text()) if titlea else '', tidy(titleb.text()) if titleb else ''
+            return tidy(titlea) if titlea else '', tidy(titleb) if titleb else ''
         
-        return tidy(''.join(i.text() for i in title))
+        return tidy(''.join(title))
 
     def get_series(self):
-        series = self.get_field(tag='490', codes=['a']) or self.get_field(tag='440', codes=['a'])
-        return tidy(series.text(), 0) if series else ''
+        series = self.get_subfield(('490', '440'), 'a')
+        return tidy(series, 0) if series is not None else ''
         # none case?
 
     def get_place(self):
-        place = self.get_field(tag='260', codes=['a']) or self.get_field(tag='264', codes=['a'])
-        return tidy(place.text()) if place else ''
+        place = self.get_subfield(('260', '264'), 'a')
+        return tidy(place) if place is not None else ''
         # none case?
 
     def get_publisher(self):
-        publisher = self.get_field(tag='260', codes=['b']) or self.get_field(tag='264', codes=['b'])
-        return tidy(publisher.text())
+        publisher = self.get_subfield(('260', '264'), 'b')
+        return tidy(publisher)
 
     def get_date(self):
-        date = self.get_field(tag='260', codes=['c']) or self.get_field(tag='264', codes=['c'])
-        return tidy(date.text())
+        date = self.get_subfield(('260', '264'), 'c')
+        return tidy(date)
         # tidy beginning [?
 
     def get_isbn(self) -> list:
-        isbns = self.get_field(tag='020', codes=['a'], first=False)
-        return [i.text() for i in isbns]
+        return self.get_subfield('020', 'a', first=False)
 
     def get_lcc(self, split=False) -> str or tuple:
-        lcc = self.get_field(tag='050', codes=('a', 'b'), first=False)
+        lcc = self.get_subfield('050', ('a', 'b'), first=False)
         class_no = get_at(lcc, 0)
-        if class_no: class_no = class_no.text()
         item_no = get_at(lcc, 1)
-        if item_no: item_no = item_no.text()
 
         if split:
             return class_no, item_no
         return class_no + ' ' + (item_no or '')
 
     def get_ddc(self) -> str:
-        ddc = self.get_field(tag='082', codes=('a'))
-        return ddc.text()
+        return self.get_subfield('082', 'a')
 
     def get_lcsh(self):
-        datafields = self.get_field(tag='650', first=False) or []
         headings = []
-        for i in datafields:
-            subdivisions = self.get_field(tree=i, codes=('a', 'v', 'x', 'y', 'z'), first=False)
-            heading = tidy('--'.join(j.text(strip=True) for j in subdivisions))
+        for i in self.get_field('650', first=False):
+            subdivisions = i.get(('a', 'v', 'x', 'y', 'z'), first=False)
+            heading = tidy('--'.join(j.strip() for j in subdivisions))
             headings.append(heading)
         return to_str(headings, ' | ')
 
     def get_summary(self):
-        summary = self.get_field(tag='520', codes=['a'])
-        return tidy(summary.text(), 1) if summary else ''
+        summary = self.get_subfield('520', 'a')
+        return tidy(summary, 1) if summary is not None else ''
 
     def get_author(self):
-        author = self.get_field(tag="100", codes=['a'])
-        return tidy(author.text()) if author else ''
+        author = self.get_subfield('100', 'a')
+        return tidy(author) if author is not None else ''
 
     def get_contributors(self) -> dict:
-        datafields = self.get_field(tag='700', first=False) or []
         contributors = {}
         ctypes = {
             'translator': 'translator',
             'editor': 'editor',
             'ÜbersetzerIn': 'translator',
         }
-        for i in datafields:
-            contributor = self.get_field(tree=i, codes=('a'))
-            ctype = self.get_field(tree=i, codes=('e'))
+        for i in self.get_field('700', first=False):
+            contributor = i.get('a')
+            ctype = i.get('e')
 
-            contributor = tidy(contributor.text()) if contributor else ''                 
-            ctype = ctypes.get(tidy(ctype.text()), 'contributor') if ctype else ''
+            contributor = tidy(contributor) if contributor is not None else ''                 
+            ctype = ctypes.get(tidy(ctype), 'contributor') if ctype is not None else ''
 
             contributors[contributor] = ctype
             
         return contributors
 
     def get_language(self):
-        language = self.get_field(tag="008").text()[35:38]
-        return language
+        control = self.get_field('008')
+        return control.text[35:38] if control else None
 
 
 class openl_record():
@@ -3,6 +3,14 @@
 import logging
 import pymupdf
 import subprocess
+import multiprocessing
+import queue
+import re
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+from selectolax.lexbor import LexborHTMLParser
 
 from libcat import CFG
 from match import match_lcc, match_isbn, match_issn, match_ddc
@@ -11,101 +19,245 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 def parse_meta(fpath, match_func):
+    return match_func(meta_text(fpath))
+
+def meta_text(fpath):
     result = subprocess.run([CFG['exiftoolpath'], fpath], capture_output=True)
-    meta = str(result.stdout)
-    match = match_func(meta)
-    return match
-    
-def parse_pdf(fpath, match_func):
-    with pymupdf.open(fpath) as doc:
-        for page in range(min(10, doc.page_count)):
-            ptext = doc[page].get_text() + "\n"
-            match = match_func(ptext)
-            if match: return match
-            
-        for page in range(max(0, doc.page_count - 10), doc.page_count):
-            ptext = doc[page].get_text() + "\n"
-            match = match_func(ptext)
-            if match: return match
-    return None
-
-def parse_epub(fpath, match_func):
-    def scan_ch_pages(chapters):
-        for i in chapters:
-            logger.debug('chapter: ', i)
-            chpagecount = doc.chapter_page_count(i)
-            logger.debug('pg:', chpagecount)
-            for j in range(chpagecount):
-                page = doc[(i,j)]
-                ptext = page.get_text() + '\n'
-                match = match_func(ptext)
-                if match: 
-                    logger.debug(f"found in page {j} in chapter {i}")
-                    return match
-
-    EPUB_FILE_SCANS = [(15, 10, 5),
-                    (10, 6, 4),
-                    (6, 4, 2),
-                    (3, 2, 1),
-                    (2, 1, 1),
-                    (1, 1, 0)]
-                    
+    return str(result.stdout)
+
+class NoTextLayer(Exception):
+    pass
+
+def pdf_pages(fpath):
+    """ text of the first 10 then the last 10 pages, each page once.
+    raises NoTextLayer without extracting anything if none of those pages uses a font, as in image-only scans """
     with pymupdf.open(fpath) as doc:
-        chapcount = doc.chapter_count
-        logger.debug('chapcount: ', chapcount)
-
-        for min_files, front_count, rear_count in EPUB_FILE_SCANS:
-            if chapcount >= min_files:
-                first_files = range(front_count)
-                last_files = []
-                if rear_count != 0:
-                    last_files = range(chapcount - rear_count, chapcount)
-                middle_files = []
-                if chapcount - min_files > 0:
-                    middle_files = range(front_count, chapcount - rear_count)
-                break
-        
-        logger.debug("first chs: %s, last chs: %s, middle chs: %s" % (first_files, last_files, middle_files))
+        pages = list(range(min(10, doc.page_count)))
+        pages += [i for i in range(max(0, doc.page_count - 10), doc.page_count) if i not in pages]
+        if pages and not any(doc[page].get_fonts() for page in pages):
+            raise NoTextLayer(fpath)
+        for page in pages:
+            yield doc[page].get_text() + "\n"
+
+EPUB_FILE_SCANS = [(15, 10, 5),
+                (10, 6, 4),
+                (6, 4, 2),
+                (3, 2, 1),
+                (2, 1, 1),
+                (1, 1, 0)]
+
+def epub_chapters(chapcount) -> tuple:
+    """ (first, last, middle) chapters to scan in that order, by EPUB_FILE_SCANS """
+    first_files, last_files, middle_files = [], [], []
+    for min_files, front_count, rear_count in EPUB_FILE_SCANS:
+        if chapcount >= min_files:
+            first_files = range(front_count)
+            if rear_count != 0:
+                last_files = range(chapcount - rear_count, chapcount)
+            if chapcount - min_files > 0:
+                middle_files = range(front_count, chapcount - rear_count)
+            break
+    logger.debug("first chs: %s, last chs: %s, middle chs: %s" % (first_files, last_files, middle_files))
+    return first_files, last_files, middle_files
+
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+BLOCK_END = re.compile(rb'</(?:p|div|li|h[1-6]|tr|td|th|dt|dd|blockquote|section|pre|table)\s*>|<br\s*/?>', re.I)
 
-        logger.debug('scanning first files')
-        result = scan_ch_pages(first_files)
-        if result: return result
+def epub_documents(z) -> list:
+    """ zip paths of an epub's spine documents in reading order, from container.xml and the opf """
+    container = ET.fromstring(z.read('META-INF/container.xml'))
+    opf_path = container.find(f'.//{CONTAINER_NS}rootfile').get('full-path')
+    opf = ET.fromstring(z.read(opf_path))
+    manifest = {i.get('id'): i.get('href') for i in opf.iter(f'{OPF_NS}item')}
+    base = posixpath.dirname(opf_path)
+    return [posixpath.normpath(posixpath.join(base, unquote(manifest[i.get('idref')]))) for i in opf.iter(f'{OPF_NS}itemref')]
 
-        logger.debug('scanning last files')
-        result = scan_ch_pages(last_files)
-        if result: return result
+BLOCK_MARK = '\u2029' # stands in for block ends while source whitespace is collapsed
+SPACES = re.compile(r'[ \t\n\r\f\v]+')
+LINE_BREAK = re.compile(f' ?{BLOCK_MARK} ?')
 
-        logger.debug('scanning middle files')
-        result = scan_ch_pages(middle_files)
-        if result: return result
-    
-    print(type(result))
-    return result
+def xhtml_text(data) -> str:
+    """ text of an xhtml document's body as rendered: whitespace runs of the source collapsed to one space,
+    with a line break after each block element """
+    mark = BLOCK_MARK.encode('utf-8')
+    tree = LexborHTMLParser(BLOCK_END.sub(lambda m: m.group(0) + mark, data))
+    text = SPACES.sub(' ', (tree.body or tree.root).text())
+    return LINE_BREAK.sub('\n', text)
 
-def mupdfepub2(fpath, match_func):
+def epub_pages(fpath):
+    """ text of the first, last, then middle spine documents, read straight from the zip without laying out pages.
+    an epub whose spine cannot be read goes through pymupdf """
+    documents = None
+    try:
+        z = zipfile.ZipFile(fpath)
+    except zipfile.BadZipFile as e:
+        z = None
+        logger.debug(f'reading epub through pymupdf: {e}')
+
+    if z:
+        with z:
+            try:
+                documents = epub_documents(z)
+            except (KeyError, ET.ParseError, AttributeError, TypeError) as e:
+                logger.debug(f'reading epub through pymupdf: {e}')
+
+            if documents is not None:
+                logger.debug(f'chapcount: {len(documents)}')
+                for chapters in epub_chapters(len(documents)):
+                    for i in chapters:
+                        try:
+                            data = z.read(documents[i])
+                        except KeyError:
+                            logger.debug(f'{documents[i]} missing from epub')
+                            continue
+                        yield xhtml_text(data) + '\n'
+                return
+
+    yield from mupdf_epub_pages(fpath)
+
+def mupdf_epub_pages(fpath):
+    """ text of the pages of the first, last, then middle chapters, as laid out by pymupdf """
     with pymupdf.open(fpath) as doc:
         chapcount = doc.chapter_count
-        for i in range(chapcount):
-            chpagecount = doc.chapter_page_count(i)
-            for j in range(chpagecount):
-                page = doc[(i,j)]
-                ptext = page.get_text()
-                match = match_func(ptext)
-                if match: return match
-    return None
+        logger.debug(f'chapcount: {chapcount}')
 
-def main(fpath, match_func, meta=0):
-    """ parses parses metadata before or after parsing file content for pdf and epub """
+        for chapters in epub_chapters(chapcount):
+            for i in chapters:
+                chpagecount = doc.chapter_page_count(i)
+                logger.debug(f'chapter: {i}, pg: {chpagecount}')
+                for j in range(chpagecount):
+                    yield doc[(i, j)].get_text() + '\n'
+
+def file_texts(fpath, meta=0):
+    """ texts of a pdf or epub in scan order, with its metadata before (meta 1) or after (meta 2) the content """
     if meta == 1:
-        match = parse_meta(fpath, match_func)
-        if match: return match
+        yield meta_text(fpath)
     if fpath.endswith('.pdf'):
-        match = parse_pdf(fpath, match_func)
-        if match: return match
+        yield from pdf_pages(fpath)
     if fpath.endswith('.epub'):
-        match = parse_epub(fpath, match_func)
-        if match: return match
+        yield from epub_pages(fpath)
     if meta == 2:
-        match = parse_meta(fpath, match_func)
-        if match: return match
-    return None
\ No newline at end of file
+        yield meta_text(fpath)
+
+def scan(fpath, matchers: dict, parseall='yes', meta=0, maxchars=0) -> tuple:
+    """ opens the file once and runs every matcher over each text, returning ({id: first match or None}, status)
+    as if each id had been scanned for in turn. matchers is {id: match function} in parsefor order;
+    with parseall 'no' only ids up to the first found one are kept.
+    status is 'ok', 'notext' for a pdf without a text layer, or 'charlimit' once maxchars characters were read """
+    ids = list(matchers)
+    found = {}
+    status = 'ok'
+    chars = 0
+
+    def wanted():
+        # with parseall no, an id after one already found can no longer matter
+        last = min((ids.index(i) for i in found), default=len(ids)) if parseall == 'no' else len(ids)
+        return [i for i in ids[:last] if i not in found]
+
+    pending = wanted()
+    texts = file_texts(fpath, meta)
+    try:
+        for text in texts:
+            for i in pending:
+                match = matchers[i](text)
+                if match:
+                    found[i] = match
+            pending = wanted()
+            if not pending:
+                break
+            chars += len(text)
+            if maxchars and chars >= maxchars:
+                logger.info(f'read {chars} characters without finding every identifier, stopping')
+                status = 'charlimit'
+                break
+    except NoTextLayer:
+        logger.info('no text layer, skipping text extraction')
+        status = 'notext'
+    texts.close()
+
+    if parseall == 'no' and found:
+        first = min(ids.index(i) for i in found)
+        ids = ids[:first + 1]
+    return {i: found.get(i) for i in ids}, status
+
+def scan_file(fpath, parsefor: list, parseall='yes', meta=0) -> tuple:
+    """ scan() with the match.py matcher of each id in parsefor and the parsemaxchars budget """
+    return scan(fpath, {i: globals()[f'match_{i}'] for i in parsefor}, parseall, meta, CFG.get('parsemaxchars', 2000000))
+
+def worker_loop(conn):
+    """ runs the scan_file jobs sent over conn until it is closed """
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = scan_file(*job)
+        except Exception as e:
+            logger.info(f'could not parse file: {e}')
+            result = {i: None for i in job[1]}, 'error'
+        conn.send(result)
+
+# workers are started, and restarted after a timeout, while the threads of a run are busy, which fork can't do safely
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    MP = multiprocessing.get_context('forkserver')
+    MP.set_forkserver_preload(['scan'])
+else:
+    MP = multiprocessing.get_context('spawn')
+
+class ScanWorker():
+    """ a child process running scan_file, killed and replaced when a file takes longer than timeout """
+    def __init__(self):
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child = MP.Pipe()
+        self.process = MP.Process(target=worker_loop, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        if self.process:
+            self.process.kill()
+            self.process.join()
+            self.conn.close()
+            self.process = None
+
+    def scan_file(self, fpath, parsefor: list, parseall='yes', meta=0, timeout=None) -> tuple:
+        if not self.process or not self.process.is_alive():
+            self.start()
+        self.conn.send((fpath, parsefor, parseall, meta))
+        if self.conn.poll(timeout or None):
+            try:
+                return self.conn.recv()
+            except EOFError: # the worker crashed
+                logger.info('parser stopped unexpectedly')
+                self.stop()
+                return {i: None for i in parsefor}, 'error'
+        logger.info(f'parsing took more than {timeout} seconds, stopping')
+        self.stop()
+        return {i: None for i in parsefor}, 'timeout'
+
+class ScanPool():
+    """ workers scan_file calls from several threads are shared out to """
+    def __init__(self, size):
+        self.workers = queue.Queue()
+        for _ in range(max(1, size)):
+            self.workers.put(ScanWorker())
+
+    def scan_file(self, fpath, parsefor: list, parseall='yes', meta=0, timeout=None) -> tuple:
+        worker = self.workers.get()
+        try:
+            return worker.scan_file(fpath, parsefor, parseall, meta, timeout)
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        while not self.workers.empty():
+            self.workers.get().stop()
+
+def main(fpath, match_func, meta=0):
+    """ parses parses metadata before or after parsing file content for pdf and epub """
+    return scan(fpath, {'id': match_func}, meta=meta)[0]['id']
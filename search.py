@@ -1,19 +1,138 @@
 # !/usr/bin/env python
 
 import logging
+import os
 import tomllib
 import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import re
 import json
-from selectolax.lexbor import LexborHTMLParser
+
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 
 import recordparser
+import isbnutils
+import throttle
+from libcat import CFG
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
+HOST_SLOTS = {}
+HOST_SLOTS_LOCK = threading.Lock()
+
+def host_slots(url):
+    """ per-host semaphore capping concurrent requests to one server """
+    host = urlsplit(url if '//' in url else f'//{url}').hostname
+    with HOST_SLOTS_LOCK:
+        if host not in HOST_SLOTS:
+            HOST_SLOTS[host] = threading.BoundedSemaphore(CFG.get('hostconcurrency', 4))
+        return HOST_SLOTS[host]
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+def get_session(url):
+    """ process-wide keep-alive session per host, shared by every Search object """
+    parts = urlsplit(url)
+    host = f'{parts.scheme}://{parts.netloc}'
+    with SESSIONS_LOCK:
+        if host not in SESSIONS:
+            session = requests.Session()
+            poolsize = CFG.get('poolsize', 10)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+            session.mount(f'{parts.scheme}://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            SESSIONS[host] = session
+        return SESSIONS[host]
+
+def fetch(url, timeout, cdict=None):
+    bucket = throttle.get_bucket(urlsplit(url).hostname, cdict)
+    if bucket:
+        bucket.acquire()
+    with host_slots(url):
+        return get_session(url).get(url, timeout = timeout)
+
+CACHE = None # cache.ResponseCache, set by libcat
+OFFLINE = False # answer only from CACHE
+WORKS = None # cache.WorkCache, set by libcat
+
+class OfflineMiss(Exception):
+    pass
+
+class TransientError(Exception):
+    """ the server is busy or rate limiting; worth retrying, after retry_after seconds if given """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class PermanentError(Exception):
+    """ retrying the same request cannot succeed """
+    pass
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(e) -> str:
+    """ 'transient' (retry with backoff), 'parse' (retry once) or 'permanent' (give up) """
+    if isinstance(e, PermanentError):
+        return 'permanent'
+    if isinstance(e, (TransientError, requests.ConnectionError, requests.Timeout)):
+        return 'transient'
+    if isinstance(e, (ValueError, KeyError, IndexError, TypeError, AttributeError)):
+        return 'parse'
+    return 'transient'
+
+BATCHES = {} # (catalog key, isbn) -> batch shared by a group of isbns, see plan_batches
+
+def isbn_key(isbn) -> str:
+    """ isbn-13 of an isbn, so 10 and 13 forms of one edition compare equal """
+    return isbnutils.canonical(isbn) or isbnutils.normalize(isbn)
+
+def catalog_key(cdict) -> tuple:
+    return cdict['cclass'], cdict.get('base_url'), cdict.get('inst_code')
+
+def capabilities(cdict) -> dict:
+    """ what a [catalogs] entry can do: its Search class's declarations, overridable in config.toml """
+    search_class = globals()[cdict['cclass']]
+    return {
+        'supplies': tuple(cdict.get('supplies', search_class.supplies)),
+        'batching': cdict.get('batching', search_class.batching),
+        'langfilter': cdict.get('langfilter', search_class.langfilter),
+    }
+
+def plan_batches(catalogs: list, isbns: list):
+    """ groups isbns so the first lookup of any of them in a batching catalog fetches the whole group """
+    size = CFG.get('batchsize', 10)
+    if size < 2 or len(isbns) < 2:
+        return
+    for cdict in catalogs:
+        if not capabilities(cdict)['batching']:
+            continue
+        for i in range(0, len(isbns), size):
+            batch = {'isbns': isbns[i:i + size], 'records': None, 'lock': threading.Lock()}
+            for isbn in batch['isbns']:
+                BATCHES[(catalog_key(cdict), isbn_key(isbn))] = batch
+
 class Search():
+    empty = None # result of request() when nothing is found
+    supplies = ('record', 'lcc', 'ddc', 'lcsh', 'isbn') # classifiers the catalog's records can hold
+    batching = False # has batch() for several isbns per request
+    langfilter = True # records carry a language to filter on
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         self.wait = wait
         self.retries = retries
@@ -23,88 +142,209 @@ class Search():
         self.langs = langs
         self.classifiers = classifiers
         self.cdict = cdict
-
-    def extract_fields(self, record) -> dict:
-        recordObj = getattr(recordparser, f"{self.cdict['recordtype']}_record")(record)
-
-        # check language
+        self.cancel = threading.Event() # set by the caller to abandon outstanding retries
+        self.fetched = [] # (url, content) of network responses from the current attempt
+        self.answered = False # a request() went through, even if nothing was found
+        self.failed = False # gave up on a request the catalog never answered
+
+    def parse_record(self, record):
+        return getattr(recordparser, f"{self.cdict['recordtype']}_record")(record)
+
+    def extract_fields(self, recordObj) -> dict:
+        """ classifiers from a response, or a list of records; with several records each classifier comes
+        from the first record that has it """
+        if isinstance(recordObj, list):
+            records = recordObj
+        else:
+            records = recordObj.split() if len(getattr(recordObj, 'records', ())) > 1 else [recordObj]
+
+        # check language (008) before anything else is read
         if self.langs:
-            for l in self.langs:
-                if l == recordObj.get_language():
-                    continue
-                else:
-                    logger.info(f"\t\tskipping: language not in {self.langs}")
-                    return {}
+            records = [i for i in records if i.get_language() in self.langs]
+            if not records:
+                logger.info(f"\t\tskipping: language not in {self.langs}")
+                return {}
 
         fields = {}
         for cl in self.classifiers:
-            try:
-                fields[cl] = getattr(recordObj, f'get_{cl}')()
-            except:
-                continue
+            for rec in records:
+                try:
+                    value = getattr(rec, f'get_{cl}')()
+                except:
+                    continue
+                if value:
+                    fields[cl] = value
+                    break
     
         return fields
-        
-    def request_or_retry(self, request, retry=0):
-        max_retries = self.retries
-        # logger.info(self.url)
 
-        if retry == max_retries:
-            return None, None
+    def batched(self) -> dict:
+        """ records of self._id's batch, fetching the whole batch on first use; {} if not batched """
+        batch = BATCHES.get((catalog_key(self.cdict), isbn_key(self._id)))
+        if not batch:
+            return {}
+        with batch['lock']:
+            if batch['records'] is None:
+                logger.info(f"\t\tbatch lookup of {len(batch['isbns'])} isbns")
+                batch['records'] = self.batch(batch['isbns'])
+        return batch['records']
         
-        try:
-            return request()
-        except Exception as e:
-            e = str(e)
-            logger.debug(f'{e}')
-            logger.info(f"\t\t{(e[:28] + '..') if len(e) > 28 else e} attempt: {retry}")
-            retry += 1
-            time.sleep(self.wait)
-            callnums = self.request_or_retry(request, retry)
-            return callnums
+    def get_content(self, url):
+        """ response body for url, from the response cache when fresh """
+        if CACHE:
+            ttl = self.cdict.get('ttl') if self.cdict else None # days
+            content = CACHE.get(url, ttl and ttl * 86400)
+            if content is not None:
+                return content
+        if OFFLINE:
+            raise OfflineMiss(url)
+
+        r = fetch(url, self.timeout, self.cdict)
+        if r.status_code in (429, 500, 502, 503, 504):
+            raise TransientError(f"http {r.status_code}", parse_retry_after(r.headers.get('Retry-After')))
+        if 400 <= r.status_code < 500:
+            raise PermanentError(f"http {r.status_code}")
+        if r.status_code == 200:
+            self.fetched.append((url, r.content))
+        return r.content
+
+    def backoff(self, attempt, retry_after=None) -> float:
+        """ seconds to wait before the next attempt: exponential with full jitter, or the server's Retry-After """
+        if retry_after is not None:
+            return min(retry_after, CFG.get('backoffmax', 60))
+        base = max(self.wait, CFG.get('backoffbase', 0.5))
+        return random.uniform(0, min(CFG.get('backoffmax', 60), base * 2 ** (attempt - 1)))
+
+    def request_or_retry(self, request):
+        attempt = 0
+        while attempt < self.retries and not self.cancel.is_set():
+            self.fetched = []
+            start = time.monotonic()
+            try:
+                result = request()
+            except OfflineMiss:
+                logger.info('\t\tnot in cache, skipping (offline)')
+                return self.empty
+            except Exception as e:
+                kind = classify_error(e)
+                elapsed = time.monotonic() - start
+                msg = str(e)
+                logger.debug(f'{msg}')
+                logger.info(f"\t\t{(msg[:28] + '..') if len(msg) > 28 else msg} attempt: {attempt}")
+                logger.debug(f"\t\tattempt {attempt} failed after {elapsed:.2f}s ({kind})")
+                attempt += 1
+                self.failed = kind != 'permanent'
+                if kind == 'permanent' or (kind == 'parse' and attempt > 1):
+                    break
+                if attempt < self.retries:
+                    self.cancel.wait(self.backoff(attempt, getattr(e, 'retry_after', None)))
+                continue
+
+            logger.debug(f"\t\tattempt {attempt} ok after {time.monotonic() - start:.2f}s")
+            self.answered = True
+            self.failed = False
+
+            # only responses that parsed are worth keeping
+            if CACHE:
+                negative = not result or result == self.empty
+                for url, content in self.fetched:
+                    CACHE.put(url, content, negative)
+            return result
+
+        # a lookup cancelled because another catalog answered did not run out of retries
+        if self.cancel.is_set():
+            self.failed = False
+        return self.empty
 
 class SRU(Search):
+    batching = True
+
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
         self.base_url = self.cdict['base_url']
         self.query = cdict['query']
-        self.srumain = "?operation=searchRetrieve&version=1.2&maximumRecords=1&recordSchema=marcxml&query="
-        self.url = f"{self.base_url}{self.srumain}{self.query}={self._id}"
+        self.srumain = "?operation=searchRetrieve&version=1.2&maximumRecords={}&recordSchema=marcxml&query="
+        self.maxrecs = cdict.get('maxrecords', CFG.get('maxrecords', 1))
+        self.url = self.make_url(f"{self.query}={self._id}")
 
-    def request(self):
-        # logger.info(self.url)
-        print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
+    def make_url(self, cql, maxrecs=None):
+        return f"{self.base_url}{self.srumain.format(maxrecs or self.maxrecs)}{cql}"
 
-        tree = LexborHTMLParser(r.content)
+    def request(self, url=None):
+        """ records of self.url, or of url for a lookup other than self._id's, such as a batch """
+        url = url or self.url
+        # logger.info(url)
+        print(url)
+        record = self.parse_record(self.get_content(url))
 
-        if tree.css_first('record'):
-            return tree, r
+        if record.records:
+            return record
 
         # check number of records
-        numrecs = tree.css_first('zs\\:numberOfRecords, numberOfRecords')
-        if numrecs:
-            if numrecs.text() == '0':
-                logger.info('\t\tno records in catalog')   
-                return None, None  
+        if record.meta.get('numberOfRecords') == '0':
+            logger.info('\t\tno records in catalog')   
+            return None
          
-        raise Exception(f"\t\terror, {tree.css_first('title').text()}")
+        raise Exception(f"\t\terror, {record.meta.get('message') or record.meta.get('title')}")
+
+    def batch(self, isbns: list) -> dict:
+        """ looks up isbns with one cql 'or' query, matching records back by their 020 isbns.
+        returns {isbn: [its records], or None if the catalog has none}; isbns left out need a single lookup """
+        cql = '%20or%20'.join(f"{self.query}={i}" for i in isbns)
+        url = self.make_url(cql, len(isbns) * CFG.get('batchrecords', 2))
+        record = super().request_or_retry(lambda: self.request(url))
+        if not self.answered:
+            return {}
+        if not record:
+            return {isbn_key(i): None for i in isbns}
+
+        records = record.split()
+        numrecs = record.meta.get('numberOfRecords')
+        complete = not numrecs or int(numrecs) <= len(records)
+
+        found = {}
+        for rec in records:
+            for isbn in rec.get_isbn():
+                matched = found.setdefault(isbn_key(isbn), [])
+                if rec not in matched:
+                    matched.append(rec)
+
+        result = {}
+        for i in isbns:
+            key = isbn_key(i)
+            if key in found:
+                result[key] = found[key]
+            elif complete:
+                result[key] = None
+        return result
 
     def main(self):
-        tree, r = super().request_or_retry(self.request)
-        return super().extract_fields(r.content) if tree else {}
+        records = self.batched()
+        key = isbn_key(self._id)
+        if key in records:
+            record = records.pop(key)
+            return super().extract_fields(record) if record else {}
+
+        record = super().request_or_retry(self.request)
+        return super().extract_fields(record) if record else {}
         
 class Alma(SRU):
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
+        self.inst_code = cdict['inst_code']
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
-        self.inst_code = self.cdict['inst_code']
-        self.url = f"https://{self.base_url}/view/sru/{self.inst_code}{self.srumain}alma.isbn={_id}"
+        self.query = 'alma.isbn'
+        self.url = self.make_url(f"{self.query}={_id}")
+
+    def make_url(self, cql, maxrecs=None):
+        return f"https://{self.base_url}/view/sru/{self.inst_code}{self.srumain.format(maxrecs or self.maxrecs)}{cql}"
     
     def main(self):
         callnums = super().main()
         return callnums
 
 class Hathi(Search):
+    batching = True
+
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
         self.url = f"https://catalog.hathitrust.org/api/volumes/full/isbn/{self._id}.json"
@@ -113,22 +353,45 @@ class Hathi(Search):
         logger.debug(self.url)
         print(self.url)
         # logger.info(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-        array = json.loads(r.content)
+        array = json.loads(self.get_content(self.url))
         if len(array['records']) == 0:
-            return None, None
+            return None
         a = list(array['records'].keys())
         a = a[0]
 
-        marcxml = array['records'][a]['marc-xml']
-        tree = LexborHTMLParser(marcxml)
-        return tree, marcxml
+        return self.parse_record(array['records'][a]['marc-xml'])
+
+    def request_batch(self, url):
+        logger.debug(url)
+        return json.loads(self.get_content(url))
+
+    def batch(self, isbns: list) -> dict:
+        """ looks up isbns in one multi-id request, returning {isbn: marcxml or None} """
+        url = "https://catalog.hathitrust.org/api/volumes/full/json/" + '|'.join(f"isbn:{i}" for i in isbns)
+        array = super().request_or_retry(lambda: self.request_batch(url))
+        if not self.answered:
+            return {}
+
+        result = {}
+        for i in isbns:
+            records = ((array or {}).get(f"isbn:{i}") or {}).get('records') or {}
+            result[isbn_key(i)] = next(iter(records.values()))['marc-xml'] if records else None
+        return result
 
     def main(self):
-        tree, marcxml = super().request_or_retry(self.request)
-        return super().extract_fields(marcxml) if tree else {}
+        records = self.batched()
+        key = isbn_key(self._id)
+        if key in records:
+            marcxml = records.pop(key)
+            return super().extract_fields(self.parse_record(marcxml)) if marcxml else {}
+
+        record = super().request_or_retry(self.request)
+        return super().extract_fields(record) if record else {}
 
 class Openl(Search):
+    supplies = ('lcc', 'ddc', 'isbn')
+    batching = True
+
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
         self.base_url = self.cdict['base_url']
@@ -137,16 +400,39 @@ class Openl(Search):
     def request(self):
         logger.debug(self.url)
         print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-        array = json.loads(r.content)
+        array = json.loads(self.get_content(self.url))
         if array == []: return None
         record = array['records']
         a = list(record)[0]
-        return record[a]
+        return self.parse_record(record[a])
+
+    def request_batch(self, url):
+        logger.debug(url)
+        return json.loads(self.get_content(url))
+
+    def batch(self, isbns: list) -> dict:
+        """ looks up isbns in one multi-id request, returning {isbn: record or None} """
+        base_url = self.base_url.rsplit('/isbn', 1)[0]
+        url = f"https://{base_url}/json/" + '|'.join(f"isbn:{i}" for i in isbns)
+        array = super().request_or_retry(lambda: self.request_batch(url))
+        if not self.answered:
+            return {}
+
+        result = {}
+        for i in isbns:
+            records = ((array or {}).get(f"isbn:{i}") or {}).get('records') or {}
+            result[isbn_key(i)] = self.parse_record(next(iter(records.values()))) if records else None
+        return result
 
     def main(self):
-        array = super().request_or_retry(self.request)
-        return super().extract_fields(array) if array else {}
+        records = self.batched()
+        key = isbn_key(self._id)
+        if key in records:
+            record = records.pop(key)
+            return super().extract_fields(record) if record else {}
+
+        record = super().request_or_retry(self.request)
+        return super().extract_fields(record) if record else {}
 
 class Bdirect(Search):
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
@@ -156,92 +442,167 @@ class Bdirect(Search):
     def request(self):
         logger.debug(self.url)
         print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-
-        array = json.loads(r.content)
+        array = json.loads(self.get_content(self.url))
         if array['resultCount'] == 0:
-            return None, None
-        marcxml = array['records'][0]['fullRecord']
-        tree = LexborHTMLParser(marcxml)
-
-        return tree, marcxml
+            return None
+        return self.parse_record(array['records'][0]['fullRecord'])
     
     def main(self):
-        tree, marcxml = super().request_or_retry(self.request)
-        return super().extract_fields(marcxml) if tree else {}
+        record = super().request_or_retry(self.request)
+        return super().extract_fields(record) if record else {}
 
 class fetch_openl_alt(Search):
+    supplies = ('lcc', 'ddc', 'isbn')
+
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
-        self.url = f"https://openlibrary.org/search.json?q=isbn={self._id}&fields=isbn,lcc,ddc"
+        self.url = f"https://openlibrary.org/search.json?q=isbn={self._id}&fields=key,isbn,lcc,ddc"
 
     def request(self):
         # logger.info(self.url)
         print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-        return json.loads(r.content)['docs']
+        return json.loads(self.get_content(self.url))['docs']
+
+    def summary(self) -> dict:
+        """ isbns, lccs and ddcs of every edition of self._id's work, from WORKS when known """
+        work = WORKS.get_work(self._id) if WORKS else None
+        summary = WORKS.get(work, 'summary') if work else None
+        if summary is not None:
+            return summary
 
-    def main(self):
         array = super().request_or_retry(self.request)
-        if array:
-            alt_isbns = array[0].get('isbn')
-            alt_lcc = array[0].get('lcc')
-            alt_ddc = array[0].get('ddc')
+        if not array:
+            return None
+        summary = {k: array[0].get(k) or [] for k in ('isbn', 'lcc', 'ddc')}
+        if WORKS and array[0].get('key'):
+            WORKS.put_work(array[0]['key'], isbnutils.dedupe(summary['isbn'] + [self._id]))
+            WORKS.put(array[0]['key'], 'summary', summary)
+        return summary
 
-            return alt_isbns, alt_lcc, alt_ddc
+    def main(self):
+        summary = self.summary()
+        if summary:
+            alt_isbns = isbnutils.dedupe(summary['isbn'], exclude=[self._id])
+            return alt_isbns, summary['lcc'], summary['ddc']
         return None, None, None
 
+EDITION_KEYS = ('isbn_13', 'isbn_10', 'lc_classifications', 'dewey_decimal_class', 'languages') # kept in WORKS
+EDITIONS_PAGE = 100 # editions per editions.json request
+
 class fetch_openl_alt_filtered(Search):
+    supplies = ('lcc', 'ddc', 'isbn')
+
     def __init__(self, wait, retries, timeout, _id, id_type, langs, classifiers, cdict):
         super().__init__(wait, retries, timeout, _id, id_type, langs, classifiers, cdict)
+        self.editions = {} # isbn-13 -> openl_record of every edition of the work, for rank_alts
 
     def request_1(self):
         self.url = f"https://openlibrary.org/isbn/{self._id}.json"
         # logger.debug(self.url)
         print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-        array = json.loads(r.content)
+        array = json.loads(self.get_content(self.url))
         work = array['works'][0]['key']
         return work
 
     def request_2(self):
-        self.url = f"https://openlibrary.org{self.work}/editions.json?limit=100&offset={self.offset}"
+        self.url = f"https://openlibrary.org{self.work}/editions.json?limit={EDITIONS_PAGE}&offset={self.offset}"
         # logger.debug(url)
         print(self.url)
-        r = requests.get(self.url, timeout = self.timeout)
-        array = json.loads(r.content)
-        entries = array['entries']
-        return entries
-
-    def main(self):
-        self.work = super().request_or_retry(self.request_1)
+        array = json.loads(self.get_content(self.url))
+        if 'entries' not in array:
+            raise KeyError('entries')
+        return array
+
+    def fetch_page(self, offset) -> dict:
+        """ one editions.json page through its own search object, so several pages can be fetched at once """
+        page = fetch_openl_alt_filtered(self.wait, self.retries, self.timeout, self._id, self.id_type, self.langs, self.classifiers, self.cdict)
+        page.cancel = self.cancel
+        page.work, page.offset = self.work, offset
+        return page.request_or_retry(page.request_2)
+
+    def iter_editions(self):
+        """ yields every edition of self.work in order. the first page gives the edition count and the
+        rest are fetched at once; a list read to the end is put in WORKS """
+        editions = WORKS.get(self.work, 'editions') if WORKS else None
+        if editions is not None:
+            yield from editions
+            return
+
+        executor = ThreadPoolExecutor(CFG.get('hostconcurrency', 4))
+
+        def pages():
+            offset = 0
+            page = self.fetch_page(offset)
+            if page is None or 'size' not in page: # no edition count, one page after another
+                while page and page['entries']:
+                    yield page
+                    offset += EDITIONS_PAGE
+                    page = self.fetch_page(offset)
+                yield page
+                return
+            yield page
+            futures = [executor.submit(self.fetch_page, i) for i in range(EDITIONS_PAGE, page['size'], EDITIONS_PAGE)]
+            for future in futures:
+                yield future.result()
+
+        editions = []
+        complete = False
+        try:
+            for page in pages():
+                if page is None:
+                    return
+                entries = [{k: i[k] for k in EDITION_KEYS if k in i} for i in page['entries']]
+                editions.extend(entries)
+                yield from entries
+            complete = True
+        finally:
+            if not complete:
+                self.cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if WORKS:
+            WORKS.put(self.work, 'editions', editions)
+            WORKS.put_work(self.work, isbnutils.dedupe(isbn for i in editions for isbn in recordparser.openl_record(i).get_isbn()))
+
+    def main(self, limit=None):
+        """ isbns, lccs and ddcs of the work's editions in langs, stopping once limit isbns are found """
+        self.work = WORKS.get_work(self._id) if WORKS else None
+        if not self.work:
+            self.work = super().request_or_retry(self.request_1)
 
         alt_isbns = []
         alt_lccs = []
         alt_ddcs = []
-        entries = True
-        self.offset = 0
-        while entries:
-            entries = super().request_or_retry(self.request_2)
-            for i in entries:
-                rec = recordparser.openl_record(i)
-
-                lang = rec.get_language()
-                if lang not in self.langs:
-                    continue
-                
-                isbns = rec.get_isbn()
-                if isbns: alt_isbns.extend(isbns)
+        if not self.work:
+            return alt_isbns, alt_lccs, alt_ddcs
+
+        matched = set()
+        editions = self.iter_editions()
+        for i in editions:
+            rec = recordparser.openl_record(i)
+            for isbn in isbnutils.dedupe(rec.get_isbn()):
+                self.editions.setdefault(isbn, rec)
+
+            lang = rec.get_language()
+            if self.langs and lang not in self.langs:
+                continue
+            
+            isbns = rec.get_isbn()
+            if isbns: alt_isbns.extend(isbns)
+
+            lcc = rec.get_lcc()
+            if lcc: alt_lccs.append(lcc)
 
-                lcc = rec.get_lcc()
-                if lcc: alt_lccs.append(lcc)
+            ddc = rec.get_ddc()
+            if ddc: alt_ddcs.append(ddc)
 
-                ddc = rec.get_ddc()
-                if ddc: alt_ddcs.append(ddc)
-                
-            self.offset += 100
+            matched.update(isbnutils.dedupe(isbns, exclude=[self._id]))
+            if limit and len(matched) >= limit:
+                logger.info(f'\t\t{limit} alt isbns found, not reading further editions')
+                break
+        editions.close()
         
-        return alt_isbns, alt_lccs, alt_ddcs
+        return isbnutils.dedupe(alt_isbns, exclude=[self._id]), alt_lccs, alt_ddcs
 
 def get_most_common_lcc(a: list) -> str:
     a = [i.split(' ')[0] for i in a]
@@ -255,4 +616,22 @@ def get_most_common_ddc(a: list) -> str:
   a = [(i, a.count(i)) for i in a]
   a = list(set(a))
   a.sort(key = lambda x: x[1])
-  return a[-1][0]
\ No newline at end of file
+  return a[-1][0]
+
+def rank_alts(source, alt_isbns: list, editions: dict, langs: list, hit_rates: dict) -> list:
+    """ alt_isbns ordered by likelihood of a catalog hit, keeping open library's order among equals.
+    ranks by language (langs, else the source edition's), classifiers open library has for the edition,
+    the hit rate of earlier jobs for the isbn prefix, then digits shared with the source isbn """
+    source = isbnutils.canonical(source) or ''
+    if not langs and source in editions:
+        langs = [editions[source].get_language()]
+
+    def score(isbn):
+        rec = editions.get(isbn)
+        lang = bool(rec and langs and rec.get_language() in langs)
+        classified = bool(rec and rec.get_lcc()) + bool(rec and rec.get_ddc())
+        hit_rate = hit_rates.get(isbn[:CFG.get('rankprefix', 8)], 0.5)
+        shared = len(os.path.commonprefix([source, isbn]))
+        return lang, classified, hit_rate, shared
+
+    return sorted(alt_isbns, key=score, reverse=True)
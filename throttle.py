@@ -0,0 +1,143 @@
+# !/usr/bin/env python
+
+import asyncio
+import logging
+import threading
+import time
+
+from libcat import CFG
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+class CircuitBreaker():
+    """ stops lookups in a catalog after `threshold` consecutive failures,
+    letting a single probe through once `cooldown` seconds have passed """
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed' # closed, open or half-open
+        self.failures = 0 # consecutive
+        self.opened = 0
+        self.trips = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened >= self.cooldown:
+                logger.info(f'\t\t{self.name} circuit half-open, probing')
+                self.state = 'half-open'
+                return True
+            self.skipped += 1
+            return False
+
+    def record(self, ok: bool):
+        with self.lock:
+            if ok:
+                if self.state != 'closed':
+                    logger.info(f'\t\t{self.name} circuit closed')
+                self.state = 'closed'
+                self.failures = 0
+                return
+
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                logger.info(f'\t\t{self.name} circuit open after {self.failures} failures')
+                self.state = 'open'
+                self.opened = time.monotonic()
+                self.trips += 1
+
+    def release(self):
+        """ ends a lookup that neither reached the catalog nor failed, e.g. cancelled, offline or served from a batch.
+        a probe like that proves nothing, so the circuit reopens and probes again after another cooldown """
+        with self.lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.opened = time.monotonic()
+
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+def get_breaker(catalog) -> CircuitBreaker:
+    with BREAKERS_LOCK:
+        if catalog not in BREAKERS:
+            BREAKERS[catalog] = CircuitBreaker(catalog, CFG.get('breakerthreshold', 5), CFG.get('breakercooldown', 300))
+        return BREAKERS[catalog]
+
+def breaker_report() -> str:
+    """ state of every catalog whose circuit opened during the run """
+    rows = [b for b in BREAKERS.values() if b.trips]
+    if not rows:
+        return ''
+    lines = [f'{"catalog":<12}{"state":<12}{"trips":>6}{"skipped":>9}']
+    lines += [f'{b.name:<12}{b.state:<12}{b.trips:>6}{b.skipped:>9}' for b in rows]
+    return '\n'.join(lines)
+
+class TokenBucket():
+    """ allows `rate` requests per second to a host, with bursts of up to `burst`.
+    tokens are reserved under a lock, so waiting callers are served in order """
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.waited = 0 # requests that had to wait
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self) -> float:
+        """ takes a token, returning the seconds to wait before it may be used """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+            self.requests += 1
+            if wait:
+                self.waited += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+BUCKETS = {}
+BUCKETS_LOCK = threading.Lock()
+
+def get_bucket(host, cdict=None) -> TokenBucket:
+    """ bucket for host, set up from the first [catalogs] entry that reaches it """
+    with BUCKETS_LOCK:
+        if host not in BUCKETS:
+            cdict = cdict or {}
+            rate = cdict.get('rate', CFG.get('rate', 5))
+            burst = cdict.get('burst', CFG.get('burst', max(1, rate)))
+            BUCKETS[host] = TokenBucket(host, rate, burst) if rate else None
+        return BUCKETS[host]
+
+def rate_report() -> str:
+    """ time requests spent waiting for a token, per host """
+    rows = [b for b in BUCKETS.values() if b and b.requests]
+    if not rows:
+        return ''
+    lines = [f'{"host":<40}{"rate":>6}{"requests":>10}{"waited":>8}{"total s":>9}{"max s":>7}']
+    lines += [f'{b.host:<40}{b.rate:>6}{b.requests:>10}{b.waited:>8}{b.total_wait:>9.1f}{b.max_wait:>7.1f}' for b in rows]
+    return '\n'.join(lines)